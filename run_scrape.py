@@ -8,18 +8,53 @@
 """
 
 import argparse
+import hashlib
 import os
 import json
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 from weatherlink.importer import Importer
 from weatherlink.models import convert_timestamp_to_datetime
-from weatherlink.utils import convert_fahrenheit_to_celsius, convert_miles_per_hour_to_meters_per_second
 
 LOCAL_DIR = "raw_data"
 AQ_DIR = os.path.join(LOCAL_DIR, "AQ")
 MET_DIR = os.path.join(LOCAL_DIR, "MET")
 COLUMNS_FN = "fields.json"
+# Parsed raw files are kept here between runs. Bump CACHE_VERSION whenever the
+# data frames produced by a loader change, so that existing shards are rebuilt
+CACHE_DIR = "cache"
+CACHE_VERSION = 2
+# Size of the blocks that the air quality CSVs are read and converted in, which
+# bounds how much of each file is held in memory at once
+CSV_BLOCK_SIZE = 8 * 1024 * 1024
+
+# Unit conversions for the imperial weatherlink measurements
+FAHRENHEIT_OFFSET = 32
+FAHRENHEIT_TO_CELSIUS = 5 / 9
+MPH_TO_MS = 0.44704
+
+# Limits outside of which measurements are removed, as a column list with
+# aligned arrays of lower and upper bounds
+THRESHOLD_COLUMNS = [
+    "Temperature (C)",
+    "Relative humidity (%)",
+    "NO (ppbV)",
+    "NO2 (ppbV)",
+    "NOx (ppbV)",
+    "CO (ppbV)",
+    "CO2 (ppmV)",
+    "CH4 (ppmV)",
+]
+THRESHOLD_LOWER = np.array([-1000, 0, 0, 0, 0, 0, 0, 0], dtype="float64")
+THRESHOLD_UPPER = np.array(
+    [np.Inf, np.Inf, 200, 200, 200, 400, 550, 100], dtype="float64"
+)
 
 
 def main():
@@ -60,6 +95,7 @@ def main():
     aq_data = load_dataset(
         load_airquality_file, aq_fields, AQ_DIR
     )
+    prune_cache([cache_dir(MET_DIR), cache_dir(AQ_DIR)])
 
     if met_data is None:
         print("Error: no clean meteorological data loaded, terminating execution.")
@@ -68,13 +104,18 @@ def main():
         print("Error: no clean air quality data loaded, terminating execution.")
         return
 
-    # Combine into a data frame, clean, and save to file
-    combined = pd.merge(met_data, aq_data, on="timestamp", how="outer")
+    # Combine into a data frame, clean, and save to file. Both datasets are
+    # sorted by timestamp, so join on it as an index rather than hashing it
+    combined = (
+        met_data.set_index("timestamp")
+        .join(aq_data.set_index("timestamp"), how="outer")
+        .reset_index()
+    )
     combined = clean(combined)
     try:
-        combined.to_csv(args.output, index=False)
+        save(combined, args.output, args.format)
         print("Cleaned data saved to {}.".format(args.output))
-    except FileNotFoundError:
+    except OSError:
         print("Cannot save to {}.".format(args.output))
 
 
@@ -92,13 +133,46 @@ def parse_args():
     parser.add_argument(
         "output",
         metavar="FILE",
-        help="Specify the output filepath to save the processed CSV data to.",
+        help="Specify the output filepath to save the processed data to.",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["csv", "parquet"],
+        default="csv",
+        help="Specify the file format to save the processed data as (default: csv).",
     )
 
     args = parser.parse_args()
     return args
 
 
+def save(df, filename, file_format):
+    """
+    Saves the cleaned data frame to disk using pyarrow's writers.
+
+    Args:
+        - df (pd.DataFrame): The cleaned data frame.
+        - filename (str): Filepath to save to.
+        - file_format (str): Either 'csv' or 'parquet'.
+
+    Returns:
+        None.
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if file_format == "parquet":
+        pq.write_table(table, filename)
+        return
+
+    # Write whole-second timestamps so they're formatted as YYYY-mm-dd HH:MM:SS.
+    # Writing timestamps to CSV needs pyarrow 6.0.1 or later, which added the
+    # cast from timestamp to string
+    index = table.schema.get_field_index("timestamp")
+    table = table.set_column(
+        index, "timestamp", table.column(index).cast(pa.timestamp("s"))
+    )
+    pacsv.write_csv(table, filename, pacsv.WriteOptions(include_header=True))
+
+
 def convert_excel_time(excel_time):
     """
     converts excel float format to pandas datetime object
@@ -115,18 +189,40 @@ def convert_excel_time(excel_time):
     return converted.dt.round("S")
 
 
+def measurement_types(fields):
+    """
+    Builds the dtypes that the loaders parse measurements as, so that the
+    combined data frame doesn't need retyping before cleaning.
+
+    Args:
+        - fields (dict): Mapping between {raw_label: clean_label}.
+
+    Returns:
+        A dict mapping every raw_label other than the timestamp to 'float64'.
+    """
+    return {raw: "float64" for raw, clean in fields.items() if clean != "timestamp"}
+
+
 def load_dataset(load_function, fields, localdir):
     """
     Loads a dataset from disk into memory, combining all observations into a
     single long pandas.DataFrame.
 
+    Files are loaded in parallel worker processes, each writing a Parquet
+    shard under CACHE_DIR as soon as it's loaded, so only one file's data
+    frame per worker is held in memory until they're combined. Shards are
+    reused on later runs while the file they were loaded from, the fields
+    mapping, and CACHE_VERSION are unchanged.
+
     Args:
         - load_function (function): The function to use to load a data file from
             this dataset into Pandas. It needs to be parameterised to accept 2
             arguments:
                 - filename
                 - fields
-            And must return a wide Pandas DataFrame with a timestamp column
+            And must return an iterable of wide Pandas DataFrames, each with a
+            timestamp column and no empty rows, or None if the file can't be
+            loaded
         - fields (dict): Mapping between {raw_label: clean_label}, where
             raw_label is the column name in the raw data on Google Drive, and
             clean_label is the desired label for our output data.
@@ -134,34 +230,210 @@ def load_dataset(load_function, fields, localdir):
             can be downloaded to.
 
     Returns:
-        A pandas.DataFrame object with 3 columns:
+        A pandas.DataFrame object sorted by timestamp with 3 columns:
             - timestamp: In YYYY-mm-dd HH:MM:SS format
             - measurand: Name of measurand as human readable string
             - value: Measurement value as float.
     """
     # Load all data into a single data frame
     print(f"Processing data from {localdir} into single file...")
-    dfs = []
-    for fn in os.listdir(localdir):
-        df = load_function(os.path.join(localdir, fn), fields)
-        if df is None:
-            continue
-
-        dfs.append(df)
-
-    # Combine all clean datasets into 1 frame and drop empty values
-    if len(dfs) >= 1:
-        combined = pd.concat(dfs)
-        combined.dropna(inplace=True, how='all')
+    shard_dir = cache_dir(localdir)
+    os.makedirs(shard_dir, exist_ok=True)
+
+    # Start on the largest files first
+    entries = sorted(
+        (entry for entry in os.scandir(localdir) if entry.is_file()),
+        key=lambda entry: entry.stat().st_size,
+        reverse=True,
+    )
+    shards = []
+    stale = []
+    for entry in entries:
+        shard = os.path.join(shard_dir, entry.name + ".parquet")
+        metadata = shard_metadata(entry, fields)
+        if shard_is_current(shard, metadata):
+            shards.append(shard)
+        else:
+            stale.append((entry.path, shard, metadata))
+
+    # Load the remaining files in parallel, one per process
+    if len(stale) >= 1:
+        with ProcessPoolExecutor() as executor:
+            loaded = executor.map(
+                partial(load_shard, load_function, fields), *zip(*stale)
+            )
+            shards.extend(shard for shard in loaded if shard is not None)
+
+    # Remove shards of files that have since been deleted or can't be loaded
+    for entry in os.scandir(shard_dir):
+        if entry.name.endswith(".parquet") and entry.path not in shards:
+            os.remove(entry.path)
+
+    # Combine all clean datasets into 1 frame, empty rows having already been
+    # dropped from each file by its loader. The shards are concatenated as
+    # Arrow chunks, and each column's Arrow buffers are freed as soon as it's
+    # converted so the combined data isn't held twice
+    if len(shards) >= 1:
+        combined = (
+            ds.dataset(shards, format="parquet")
+            .to_table()
+            .to_pandas(split_blocks=True, self_destruct=True)
+        )
+        # Sort by time so datasets can be joined on their timestamps
+        combined.sort_values("timestamp", inplace=True, kind="mergesort")
     else:
         combined = None
 
     return combined
 
 
+def load_shard(load_function, fields, filename, shard, metadata):
+    """
+    Loads a raw data file and saves it as a Parquet shard.
+
+    Each data frame from load_function is appended to the shard as soon as
+    it's produced, so only one is held in memory at a time. This is run in a
+    worker process, so load_function must be picklable (i.e. defined at module
+    level).
+
+    Args:
+        - load_function (function): The function to load the file with, as
+            described in load_dataset.
+        - fields (dict): Mapping between {raw_label: clean_label}.
+        - filename (str): File to load.
+        - shard (str): Filepath to save the Parquet shard to.
+        - metadata (dict): The shard_metadata of the raw file, stored in the
+            shard's schema.
+
+    Returns:
+        The shard filepath if the file was loaded, None otherwise.
+    """
+    frames = load_function(filename, fields)
+    if frames is None:
+        return None
+
+    writer = None
+    try:
+        for df in frames:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            del df
+            if writer is None:
+                schema = table.schema.with_metadata(
+                    {**(table.schema.metadata or {}), **metadata}
+                )
+                writer = pq.ParquetWriter(shard, schema)
+            writer.write_table(table)
+    except ValueError:
+        # Raised by Arrow when a later part of the file can't be parsed
+        print("Unable to parse {}, skipping contents.".format(filename))
+        if writer is not None:
+            writer.close()
+            os.remove(shard)
+        return None
+
+    if writer is None:
+        print("{} is empty, skipping contents.".format(filename))
+        return None
+
+    writer.close()
+    return shard
+
+
+def cache_dir(localdir):
+    """
+    Finds the directory that a dataset's Parquet shards are cached in.
+
+    Each dataset gets a single directory directly under CACHE_DIR, named after
+    the dataset's directory and a short hash of its absolute path, so the
+    shards can never be written alongside (or sweep away) the raw files
+    themselves.
+
+    Args:
+        - localdir (string): Filepath to the directory of raw data files.
+
+    Returns:
+        The filepath of the cache directory.
+    """
+    path = os.path.abspath(localdir)
+    digest = hashlib.sha1(path.encode()).hexdigest()[:8]
+    return os.path.join(CACHE_DIR, "{}-{}".format(os.path.basename(path), digest))
+
+
+def prune_cache(keep):
+    """
+    Removes cached shards of datasets that are no longer loaded, e.g. after the
+    checkout has been moved, so that CACHE_DIR doesn't grow without bound.
+
+    Only Parquet files and the directories left empty by removing them are
+    deleted.
+
+    Args:
+        - keep (list): Filepaths of the cache directories (from cache_dir) that
+            are still in use.
+
+    Returns:
+        None.
+    """
+    keep = {os.path.abspath(path) for path in keep}
+    for root, _, filenames in os.walk(CACHE_DIR, topdown=False):
+        if os.path.abspath(root) in keep:
+            continue
+        for filename in filenames:
+            if filename.endswith(".parquet"):
+                os.remove(os.path.join(root, filename))
+        if os.path.abspath(root) != os.path.abspath(CACHE_DIR) and not os.listdir(root):
+            os.rmdir(root)
+
+
+def shard_metadata(entry, fields):
+    """
+    Describes the inputs a cached Parquet shard was built from.
+
+    rclone sets the modification time of each downloaded file to that on
+    Google Drive, so together with the size this identifies a version of the
+    raw file. CACHE_VERSION identifies the version of the loaders.
+
+    Args:
+        - entry (os.DirEntry): The raw data file.
+        - fields (dict): Mapping between {raw_label: clean_label}.
+
+    Returns:
+        A dict of bytes suitable for use as Parquet schema metadata.
+    """
+    stat = entry.stat()
+    return {
+        b"source_mtime_ns": str(stat.st_mtime_ns).encode(),
+        b"source_size": str(stat.st_size).encode(),
+        b"fields": json.dumps(fields, sort_keys=True).encode(),
+        b"cache_version": str(CACHE_VERSION).encode(),
+    }
+
+
+def shard_is_current(shard, metadata):
+    """
+    Checks whether a cached Parquet shard can be used in place of reloading
+    its raw file.
+
+    Args:
+        - shard (str): Filepath of the Parquet shard.
+        - metadata (dict): The shard_metadata of the raw file as it is now.
+
+    Returns:
+        True if the shard exists and was built from the same inputs, False
+        otherwise.
+    """
+    try:
+        cached = pq.read_schema(shard).metadata or {}
+    except (FileNotFoundError, pa.ArrowInvalid):
+        return False
+
+    return all(cached.get(key) == value for key, value in metadata.items())
+
+
 def load_airquality_file(filename, fields):
     """
-    Reads CSV file containing air quality data into memory.
+    Reads CSV file containing air quality data into memory, one block at a
+    time.
 
     Subsets dataset into fields of interest and converts timestamp from Excel
     format into ISO 8061.
@@ -173,23 +445,53 @@ def load_airquality_file(filename, fields):
             clean_label is the desired label for our output data.
 
     Returns:
-        A pandas.DataFrame object with as many columns as there are entries in
-        fields, with the columns set as the attributes if the read is successful,
-        None otherwise.
+        An iterator of pandas.DataFrame objects, one per block of the file, with
+        as many columns as there are entries in fields, with the columns set as
+        the attributes if the file can be opened, None otherwise.
     """
-    try:
-        df = pd.read_csv(filename, usecols=fields.keys(), header=0)
-    except pd.errors.EmptyDataError:
+    if os.path.getsize(filename) == 0:
         print("{} is empty, skipping contents.".format(filename))
         return None
-    except (pd.errors.ParserError, ValueError) as ex:
+
+    # Read measurements as floats and leave the timestamp as text for pandas.
+    # Files are already parsed in parallel worker processes, so each is read on
+    # a single thread rather than starting a thread per CPU in every worker
+    column_types = {raw: "string" for raw in fields.keys()}
+    column_types.update(measurement_types(fields))
+    try:
+        reader = pacsv.open_csv(
+            filename,
+            read_options=pacsv.ReadOptions(use_threads=False, block_size=CSV_BLOCK_SIZE),
+            convert_options=pacsv.ConvertOptions(
+                include_columns=list(fields.keys()), column_types=column_types
+            ),
+        )
+    except (pa.ArrowInvalid, pa.ArrowKeyError) as ex:
         print("Unable to parse {} as CSV, skipping contents.".format(filename))
         return None
 
+    return (convert_airquality_batch(batch, fields) for batch in reader)
+
+
+def convert_airquality_batch(batch, fields):
+    """
+    Converts a block of rows read from an air quality CSV into a data frame.
+
+    Args:
+        - batch (pyarrow.RecordBatch): The rows read from the file.
+        - fields (dict): Mapping between {raw_label: clean_label}.
+
+    Returns:
+        A pandas.DataFrame object with the clean labels as columns.
+    """
     # Rename columns to have the specified labels
-    df = df.rename(columns=fields)
+    table = pa.Table.from_batches([batch])
+    df = table.rename_columns([fields[col] for col in table.column_names]).to_pandas()
+    del table
     # Parse timestamp (it's in mm/dd/YY HH:MM:SS)
     df["timestamp"] = pd.to_datetime(df["timestamp"])
+    # Drop empty rows
+    df = df.dropna(how='all')
 
     return df
 
@@ -208,9 +510,9 @@ def load_met_file(filename, fields):
             clean_label is the desired label for our output data.
 
     Returns:
-        A pandas.DataFrame object with as many columns as there are entries in
-        fields, with the columns set as the attributes if the read is successful,
-        None otherwise.
+        A list holding a single pandas.DataFrame object with as many columns as
+        there are entries in fields, with the columns set as the attributes if
+        the read is successful, None otherwise.
     """
     try:
         importer = Importer(filename)
@@ -222,22 +524,9 @@ def load_met_file(filename, fields):
         print("Cannot read file {}.".format(filename))
         return None
 
-    # Limit fields to those required
-    clean_fields = [{field: row[field] for field in fields.keys()} for row in importer.records]
-
-    # Convert fields to ISO8061/metric. These weatherlink conversion functions
-    # aren't vectorised
-    for record in clean_fields:
-        if record['timestamp'] is not None:
-            record['timestamp'] = convert_timestamp_to_datetime(record['timestamp'])
-        if record['temperature_outside'] is not None:
-            record['temperature_outside'] = convert_fahrenheit_to_celsius(record['temperature_outside'])
-        if record['wind_speed'] is not None:
-            record['wind_speed'] = convert_miles_per_hour_to_meters_per_second(record['wind_speed'])
-
-    # Parse list of dicts as pandas data frame
+    # Parse records as pandas data frame, limiting fields to those required
     try:
-        df = pd.DataFrame(clean_fields)
+        df = pd.DataFrame.from_records(importer.records, columns=list(fields.keys()))
     except pd.errors.EmptyDataError:
         print("{} is empty, skipping contents.".format(filename))
         return None
@@ -245,17 +534,36 @@ def load_met_file(filename, fields):
         print("Unable to parse {} as CSV, skipping contents.".format(filename))
         return None
 
-    # Rename columns to have the specified labels
-    df = df.rename(columns=fields)
+    # Set all columns except timestamp as float
+    df = df.astype(measurement_types(fields), copy=False)
 
-    return df
+    # Convert fields to ISO8061/metric. The unit conversions are applied to
+    # whole columns at once, while the packed weatherlink timestamp still needs
+    # decoding by the library one value at a time. Missing timestamps make
+    # pandas store the column as floats, so only decode the valid ones, as ints
+    timestamps = df["timestamp"]
+    valid = timestamps.notna()
+    df["timestamp"] = pd.to_datetime(
+        timestamps[valid].astype("int64").map(convert_timestamp_to_datetime)
+    ).reindex(timestamps.index)
+    df["temperature_outside"] = (
+        df["temperature_outside"] - FAHRENHEIT_OFFSET
+    ) * FAHRENHEIT_TO_CELSIUS
+    df["wind_speed"] = df["wind_speed"] * MPH_TO_MS
+
+    # Rename columns to have the specified labels and drop empty rows
+    df = df.rename(columns=fields, copy=False)
+    df = df.dropna(how='all')
+
+    return [df]
 
 
 def clean(df):
     """
     Cleans the final data frame.
 
-    Currently this just removes values outside of hardcoded limits.
+    Removes values outside of the limits given by THRESHOLD_LOWER and
+    THRESHOLD_UPPER, then averages to 1 minute resolution.
 
     Args:
         - df (pd.DataFrame): The input data frame.
@@ -263,52 +571,32 @@ def clean(df):
     Returns:
         A pd.DataFrame.
     """
-    thresholds = {
-        "Temperature (C)": {
-            "lower": -1000,
-            "upper": np.Inf
-        },
-        "Relative humidity (%)": {
-            "lower": 0,
-            "upper": np.Inf
-        },
-        "NO (ppbV)": {
-            "lower": 0,
-            "upper": 200
-        },
-        "NO2 (ppbV)": {
-            "lower": 0,
-            "upper": 200
-        },
-        "NOx (ppbV)": {
-            "lower": 0,
-            "upper": 200
-        },
-        "CO (ppbV)": {
-            "lower": 0,
-            "upper": 400
-        },
-        "CO2 (ppmV)": {
-            "lower": 0,
-            "upper": 550
-        },
-        "CH4 (ppmV)": {
-            "lower": 0,
-            "upper": 100
-        }
-    }
-    for col in thresholds:
-        if col in df.columns:
-            df.loc[df[col] <= thresholds[col]["lower"], col] = np.NaN
-            df.loc[df[col] >= thresholds[col]["upper"], col] = np.NaN
-
-    # Set all columns except timestamp as float
-    types = {k: 'float64' for k in df.columns}
-    types['timestamp'] = 'datetime64[ns]'
-    df = df.astype(types)
-
-    # Resample to 1 minute average
-    df = df.set_index('timestamp').resample("1 Min").mean().reset_index()
+    # Bin timestamps into integer minutes since the epoch, dropping rows
+    # without one as resampling a DatetimeIndex would
+    df = df[df["timestamp"].notna()]
+    minutes = df["timestamp"].values.astype("datetime64[m]").view("int64")
+
+    # Blank values outside of each column's limits and average to 1 minute
+    # resolution in a single pass over the block of measurements
+    value_cols = [col for col in df.columns if col != "timestamp"]
+    # Copy so the block can be masked in place without writing through to
+    # (possibly read-only) data frame memory
+    block = df[value_cols].to_numpy(dtype="float64", copy=True)
+    present = np.array([col in value_cols for col in THRESHOLD_COLUMNS], dtype=bool)
+    limited = [value_cols.index(col) for col in THRESHOLD_COLUMNS if col in value_cols]
+    with np.errstate(invalid="ignore"):
+        values = block[:, limited]
+        valid = (values > THRESHOLD_LOWER[present]) & (values < THRESHOLD_UPPER[present])
+    block[:, limited] = np.where(valid, values, np.nan)
+    df = pd.DataFrame(block, columns=value_cols).groupby(minutes, sort=True).mean()
+    # Nothing to average, e.g. when every file was header-only
+    if len(df) == 0:
+        df.insert(0, "timestamp", pd.Series(dtype="datetime64[ns]"))
+        return df.reset_index(drop=True)
+    # Keep a row for every minute in the period, as resampling does
+    df = df.reindex(np.arange(df.index.min(), df.index.max() + 1))
+    df.insert(0, "timestamp", pd.to_datetime(df.index.values.astype("datetime64[m]")))
+    df = df.reset_index(drop=True)
 
     # Remove March 2021 CH4 and C0
     if 'CH4 (ppmV)' in df.columns and 'CO2 (ppmV)' in df.columns:
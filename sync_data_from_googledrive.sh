@@ -2,9 +2,10 @@
 
 cd ~/WACL/COZI_scrape
 
-# Downloads latest raw data
-rclone --config rclone.conf --include *.wlk -v --drive-shared-with-me sync CoziDrive:WACLroof raw_data/MET
-rclone --config rclone.conf --include cozi_all_data_* -v --drive-shared-with-me sync CoziDrive:COZI_DATA raw_data/AQ
+# Downloads latest raw data, listing each remote in as few API calls as
+# possible and fetching several files in parallel
+rclone --config rclone.conf --include *.wlk -v --drive-shared-with-me --transfers 8 --fast-list sync CoziDrive:WACLroof raw_data/MET
+rclone --config rclone.conf --include cozi_all_data_* -v --drive-shared-with-me --transfers 8 --fast-list sync CoziDrive:COZI_DATA raw_data/AQ
 
 # Pre-processes it into a single CSV
 ~/.conda/envs/coziscrape/bin/python run_scrape.py clean_data/cozi_data.csv